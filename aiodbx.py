@@ -1,11 +1,84 @@
 import os
 import json
+import math
+import time
 import base64
+import socket
+import random
+import functools
+import contextlib
 import typing
 import logging
+import datetime
+import email.utils
 import aiohttp
 import asyncio
-import aiofiles
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# opt-in, since changing the event loop policy affects the whole program
+if os.environ.get('AIODBX_UVLOOP') == '1':
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
+
+
+def _dumps(obj: typing.Any) -> bytes:
+    '''
+    Serializes a request body to JSON, using orjson if it is installed.
+    Not used for the Dropbox-API-Arg header, which must stay ASCII-escaped.
+    '''
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+
+def _loads(data: typing.Union[str, bytes]) -> typing.Any:
+    '''
+    Parses a JSON response body, using orjson if it is installed.
+    '''
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _retry_after(resp: aiohttp.ClientResponse) -> typing.Optional[float]:
+    '''
+    Parses the Retry-After header of a response, given either in seconds or as an HTTP date.
+    Returns the number of seconds to wait (never negative), or None if the header is missing or invalid.
+    '''
+    retry_after = resp.headers.get('Retry-After')
+    if retry_after is None:
+        return None
+
+    try:
+        seconds = float(retry_after)
+    except ValueError:
+        pass
+    else:
+        # ignore inf/nan, and never wait a negative amount
+        return max(seconds, 0) if math.isfinite(seconds) else None
+
+    try:
+        retry_at = email.utils.parsedate_to_datetime(retry_after)
+        delay = (retry_at -
+                 datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+        return max(delay, 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def _open_upload(path: str) -> typing.BinaryIO:
+    '''
+    Opens a file to be used as an upload body.
+    aiohttp streams file objects to the socket from a thread and closes them once they are sent, so the file is never fully loaded into memory.
+    '''
+    return open(path, 'rb', buffering=1 << 20)
 
 
 class DropboxAPIError(Exception):
@@ -17,15 +90,34 @@ class DropboxAPIError(Exception):
         self.message = message
         super().__init__(self.message)
 
-    def __str__(self):
-        if isinstance(self.message, str):
+        # parse JSON error bodies once, so repeated str() calls are cheap
+        self._summary = message
+        if isinstance(message, str):
             try:
-                self.message = json.loads(self.message)
-                return f'{self.status} {self.message["error_summary"]}'
-            except:
-                return f'{self.status} {self.message}'
-        else:
-            return f'{self.status} {self.message}'
+                parsed = _loads(message)
+                if isinstance(parsed, dict):
+                    self._summary = parsed['error_summary']
+            except (ValueError, KeyError):
+                pass
+
+    def __str__(self):
+        return f'{self.status} {self._summary}'
+
+
+class _NoDelayConnector(aiohttp.TCPConnector):
+    '''
+    TCPConnector that explicitly disables Nagle's algorithm on every new connection,
+    so small JSON requests aren't held back waiting for delayed ACKs.
+    '''
+    async def _wrap_create_connection(self, *args: typing.Any,
+                                      **kwargs: typing.Any) -> typing.Any:
+        transport, proto = await super()._wrap_create_connection(
+            *args, **kwargs)
+        sock = transport.get_extra_info('socket')
+        if sock is not None and sock.family in (socket.AF_INET,
+                                                socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return transport, proto
 
 
 class Request:
@@ -43,17 +135,40 @@ class Request:
     retry_count:
         number of times that the request will be retried (default is 5)
     retry_statuses:
-        list of statuses that will cause the request to be automatically retried (default is [429])
+        list of statuses that will cause the request to be automatically retried (default is [429, 500, 502, 503, 504])
+    backoff_base:
+        minimum number of seconds to wait between retries when the API does not send a Retry-After header (default is 0.5)
+    backoff_cap:
+        maximum number of seconds to wait between retries, also applied to Retry-After values (default is 60)
+    on_retry:
+        callable that is called with the status whenever the request is retried (default is None)
+    on_success:
+        callable that is called with the status whenever the request succeeds (default is None)
+    trace_request_ctx:
+        extra context passed to aiohttp request tracing, alongside the current attempt number (default is None)
     **kwargs:
         Arbitrary keyword arguments, passed thru to the `request` Callable.
+        If `data` is a callable, it is called on every attempt to create a fresh request body, which allows streamed bodies to be retried.
     '''
+
+    # one Request is created per API call, slots keep that allocation small
+    __slots__ = ('request', 'url', 'log', 'ok_statuses', 'retry_count',
+                 'retry_statuses', 'backoff_base', 'backoff_cap', 'on_retry',
+                 'on_success', 'kwargs', 'trace_request_ctx', '_endpoint_name',
+                 'current_attempt', 'resp', '_prev_sleep')
+
     def __init__(self,
                  request: typing.Callable[..., typing.Any],
                  url: str,
                  log: logging.Logger = logging.getLogger('null'),
                  ok_statuses: list[int] = [200],
                  retry_count: int = 5,
-                 retry_statuses: list[int] = [429],
+                 retry_statuses: list[int] = [429, 500, 502, 503, 504],
+                 backoff_base: float = 0.5,
+                 backoff_cap: float = 60,
+                 on_retry: typing.Optional[typing.Callable[[int], None]] = None,
+                 on_success: typing.Optional[typing.Callable[[int], None]] = None,
+                 trace_request_ctx: typing.Optional[dict] = None,
                  **kwargs: typing.Any):
         self.request = request
         self.url = url
@@ -61,11 +176,39 @@ class Request:
         self.ok_statuses = ok_statuses
         self.retry_count = retry_count
         self.retry_statuses = retry_statuses
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.on_retry = on_retry
+        self.on_success = on_success
         self.kwargs = kwargs
-        self.trace_request_ctx = kwargs.pop('trace_request_ctx', {})
+        self.trace_request_ctx = trace_request_ctx
+
+        # only used for debug messages, e.g. 'files/download' for .../2/files/download
+        debug_enabled = log.isEnabledFor(logging.DEBUG)
+        self._endpoint_name = url.split('/2/', 1)[-1] if debug_enabled else ''
 
         self.current_attempt = 0
         self.resp: typing.Optional[aiohttp.ClientResponse] = None
+        self._prev_sleep = backoff_base
+
+    def _backoff(self, resp: aiohttp.ClientResponse) -> float:
+        '''
+        Computes how long to wait before retrying a request.
+        Uses the Retry-After header if the API sent one, either in seconds or as an HTTP date.
+        Otherwise uses decorrelated jitter so that concurrent requests don't retry in lockstep.
+
+        Returns:
+            float: number of seconds to sleep before the next attempt
+        '''
+
+        retry_after = _retry_after(resp)
+        if retry_after is not None:
+            return min(retry_after, self.backoff_cap)
+
+        self._prev_sleep = min(
+            self.backoff_cap,
+            random.uniform(self.backoff_base, self._prev_sleep * 3))
+        return self._prev_sleep
 
     async def _do_request(self) -> aiohttp.ClientResponse:
         '''
@@ -79,37 +222,60 @@ class Request:
             DropboxAPIError: If the response status is >= 400 and if it is not in `self.ok_statuses`
         '''
 
-        self.current_attempt += 1
-        if self.current_attempt > 1:
-            self.log.debug(
-                f'Attempt {self.current_attempt} out of {self.retry_count}')
-
-        resp: aiohttp.ClientResponse = await self.request(
-            self.url,
-            **self.kwargs,
-            trace_request_ctx={
-                'current_attempt': self.current_attempt,
-                **self.trace_request_ctx,
-            },
-        )
-
-        if resp.status in self.ok_statuses or resp.status < 400:
-            endpoint_name = self.url[self.url.index('2') + 1:]
-            self.log.debug(
-                f'Request OK: {endpoint_name} returned {resp.status}')
-        else:
-            raise DropboxAPIError(resp.status, await resp.text())
-
-        if self.current_attempt < self.retry_count and resp.status in self.retry_statuses:
-            if 'Retry-After' in resp.headers:
-                sleep_time = int(resp.headers['Retry-After'])
+        while True:
+            self.current_attempt += 1
+            if self.current_attempt > 1:
+                self.log.debug('Attempt %d out of %d', self.current_attempt,
+                               self.retry_count)
+
+            kwargs = self.kwargs
+            body = None
+            if callable(kwargs.get('data')):
+                body = kwargs['data']()
+                kwargs = {**kwargs, 'data': body}
+
+            trace_request_ctx = {'current_attempt': self.current_attempt}
+            if self.trace_request_ctx:
+                trace_request_ctx.update(self.trace_request_ctx)
+
+            try:
+                resp: aiohttp.ClientResponse = await self.request(
+                    self.url,
+                    **kwargs,
+                    trace_request_ctx=trace_request_ctx,
+                )
+            except BaseException:
+                # aiohttp only closes file bodies once they are sent
+                if hasattr(body, 'close'):
+                    body.close()
+                raise
+
+            if self.current_attempt < self.retry_count and resp.status in self.retry_statuses:
+                if self.on_retry is not None:
+                    self.on_retry(resp.status)
+                sleep_time = self._backoff(resp)
+                # this response won't be returned, give its connection back to the pool
+                resp.release()
+                self.log.debug('Got status %d, retrying in %.2f seconds',
+                               resp.status, sleep_time)
+                await asyncio.sleep(sleep_time)
+                continue
+
+            if resp.status in self.ok_statuses or resp.status < 400:
+                self.log.debug('Request OK: %s returned %d',
+                               self._endpoint_name, resp.status)
+                if self.on_success is not None:
+                    self.on_success(resp.status)
             else:
-                sleep_time = 1
-            await asyncio.sleep(sleep_time)
-            return await self._do_request()
+                try:
+                    # decode directly, resp.text() may guess the charset from the body
+                    message = (await resp.read()).decode('utf-8', 'replace')
+                finally:
+                    resp.release()
+                raise DropboxAPIError(resp.status, message)
 
-        self.resp = resp
-        return resp
+            self.resp = resp
+            return resp
 
     def __await__(
             self
@@ -128,30 +294,195 @@ class Request:
 class AsyncDropboxAPI:
     '''
     Dropbox API client using asynchronous HTTP requests.
+    Use it in an `async with` block, or call `close` when done with it, so the HTTP session is closed.
 
     Args:
         token:
             a Dropbox API access token
         retry_statuses:
-            list of statuses that will automatically be retried (default is [429])
+            list of statuses that will automatically be retried (default is [429, 500, 502, 503, 504])
         log:
             logger to use for log messages (default is a null logger)
+        backoff_base:
+            minimum number of seconds to wait between retries (default is 0.5)
+        backoff_cap:
+            maximum number of seconds to wait between retries (default is 60)
+        max_concurrency:
+            maximum number of requests in flight at once (default is 50).
+            The actual limit shrinks automatically when the API starts rate limiting, and grows back as requests succeed.
+        validate_ttl:
+            number of seconds a successful `validate` result is cached for (default is 300)
+        file_concurrency:
+            maximum number of files being uploaded or downloaded at once (default is 16)
     '''
+
+    # weight given to the latest request when updating the rate limit average
+    _ewma_alpha = 0.2
+    # number of consecutive successful requests before the concurrency limit is raised again
+    _grow_after = 10
+
     def __init__(self,
                  token: str,
-                 retry_statuses: list[int] = [429],
-                 log: logging.Logger = None):
+                 retry_statuses: list[int] = [429, 500, 502, 503, 504],
+                 log: logging.Logger = None,
+                 backoff_base: float = 0.5,
+                 backoff_cap: float = 60,
+                 max_concurrency: int = 50,
+                 validate_ttl: float = 300,
+                 file_concurrency: int = 16):
         self.token = token
         self.retry_statuses = retry_statuses
-        self.client_session = aiohttp.ClientSession(
-            connector=aiohttp.TCPConnector(limit_per_host=50))
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self._auth = f'Bearer {token}'
+        # no total limit, large transfers can legitimately take a long time
+        self._timeout = aiohttp.ClientTimeout(total=None,
+                                              sock_connect=30,
+                                              sock_read=300)
+
+        # created on first use, see _session
+        self.client_session: typing.Optional[aiohttp.ClientSession] = None
+        self._post: typing.Optional[typing.Callable[..., typing.Any]] = None
         self.upload_session: list[dict] = []
+        self._upload_pending = 0  # upload_start calls that haven't returned yet
+        self._file_sem = asyncio.Semaphore(file_concurrency)
 
         self.log = log or logging.getLogger('null')
 
+        # headers shared by every request, endpoints only add their Dropbox-API-Arg
+        self._json_headers = {"Content-Type": "application/json"}
+        self._octet_headers = {"Content-Type": "application/octet-stream"}
+        # upload_start always sends the same argument
+        self._upload_start_headers = {
+            **self._octet_headers,
+            "Dropbox-API-Arg": '{"close":true}'
+        }
+
+        # monotonic time of the last successful validation, None if not validated
+        self._validated_at: typing.Optional[float] = None
+        self._validate_ttl = validate_ttl
+
+        # adaptive concurrency limit, see _throttle
+        self.max_concurrency = max_concurrency
+        self._concurrency = max_concurrency
+        self._inflight = 0
+        self._throttle_cond = asyncio.Condition()
+        self._429_ewma = 0.0
+        self._ok_streak = 0
+
+        # Request with everything but the url and per-call arguments filled in
+        self._req = functools.partial(Request,
+                                      log=self.log,
+                                      retry_statuses=self.retry_statuses,
+                                      backoff_base=self.backoff_base,
+                                      backoff_cap=self.backoff_cap,
+                                      on_retry=self._on_429,
+                                      on_success=self._on_ok)
+
+    def _session(self) -> aiohttp.ClientSession:
+        '''
+        Returns the HTTP session, creating it the first time it is needed.
+        The session's bound `post` method is kept in `self._post` so requests don't have to look it up every time.
+        Should not be called directly, this is used internally by `_request`.
+        '''
+
+        if self.client_session is None:
+            # the Authorization header is set once on the session and sent with every request
+            self.client_session = aiohttp.ClientSession(
+                connector=_NoDelayConnector(limit=200,
+                                            limit_per_host=50,
+                                            use_dns_cache=True,
+                                            ttl_dns_cache=300,
+                                            keepalive_timeout=75,
+                                            enable_cleanup_closed=True),
+                headers={"Authorization": self._auth},
+                timeout=self._timeout,
+                # larger response buffer, so downloads are read in fewer, bigger pieces
+                read_bufsize=1 << 22)
+            self._post = self.client_session.post
+        return self.client_session
+
+    @contextlib.asynccontextmanager
+    async def _throttle(self) -> typing.AsyncIterator[None]:
+        '''
+        Waits for a free slot under the current concurrency limit and holds it for the duration of the block.
+        Should not be called directly, this is used internally by `_request`.
+        '''
+
+        async with self._throttle_cond:
+            await self._throttle_cond.wait_for(
+                lambda: self._inflight < self._concurrency)
+            self._inflight += 1
+        try:
+            yield
+        finally:
+            async with self._throttle_cond:
+                self._inflight -= 1
+                # wake a waiter for every free slot, the limit may have grown in the meantime
+                self._throttle_cond.notify(self._concurrency - self._inflight)
+
+    def _on_429(self, status: int) -> None:
+        '''
+        Updates the rate limit average after a rate limited request and shrinks the concurrency limit accordingly.
+        Other retried statuses (e.g. 5xx server errors) are not rate limiting and are ignored.
+        '''
+
+        if status != 429:
+            return
+
+        self._ok_streak = 0
+        self._429_ewma += self._ewma_alpha * (1 - self._429_ewma)
+        limit = max(1, round(self.max_concurrency * (1 - self._429_ewma)))
+        if limit < self._concurrency:
+            self.log.debug('Rate limited, lowering concurrency to %d', limit)
+            self._concurrency = limit
+
+    def _on_ok(self, status: int) -> None:
+        '''
+        Decays the rate limit average after a successful request, and raises the concurrency limit after a run of successes.
+        '''
+
+        self._429_ewma *= 1 - self._ewma_alpha
+        self._ok_streak += 1
+        if self._ok_streak >= self._grow_after and self._concurrency < self.max_concurrency:
+            self._ok_streak = 0
+            self._concurrency += 1
+            self.log.debug('Raising concurrency to %d', self._concurrency)
+
+    @contextlib.asynccontextmanager
+    async def _request(
+            self, url: str,
+            **kwargs: typing.Any) -> typing.AsyncIterator[aiohttp.ClientResponse]:
+        '''
+        Performs a POST Request using this client's session, logger and retry settings, subject to the adaptive concurrency limit.
+        Should not be called directly, this is used internally by the API methods.
+
+        Args:
+            url:
+                url to request
+            **kwargs:
+                Arbitrary keyword arguments, passed thru to `Request`.
+        Yields:
+            aiohttp.ClientResponse:
+                the response, which is closed when the `async with` block exits
+        '''
+
+        async with self._throttle():
+            try:
+                if self._post is None:
+                    self._session()
+                async with self._req(self._post, url, **kwargs) as resp:
+                    yield resp
+            except DropboxAPIError as e:
+                # token was rejected, force the next validate call to check again
+                if e.status == 401:
+                    self._validated_at = None
+                raise
+
     async def validate(self):
         '''
         Validates the user authentication token.
+        A successful result is cached for `validate_ttl` seconds, or until a request is rejected with a 401.
         https://www.dropbox.com/developers/documentation/http/documentation#check-user
 
         Returns:
@@ -162,31 +493,83 @@ class AsyncDropboxAPI:
                 If the token is invalid
         '''
 
+        if self._validated_at is not None and time.monotonic() - self._validated_at < self._validate_ttl:
+            self.log.debug('Token was validated recently, skipping check')
+            return True
+
         self.log.debug('Validating token')
 
         nonce = base64.b64encode(os.urandom(8), altchars=b'-_').decode('utf-8')
         url = 'https://api.dropboxapi.com/2/check/user'
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Content-Type": "application/json",
-        }
-        data = json.dumps({'query': nonce})
-
-        async with Request(self.client_session.post,
-                           url,
-                           self.log,
-                           headers=headers,
-                           data=data) as resp:
-            resp_data = await resp.json()
+        headers = self._json_headers
+        data = _dumps({'query': nonce})
+
+        async with self._request(url,
+                                 headers=headers,
+                                 data=data) as resp:
+            resp_data = _loads(await resp.read())
             if resp_data['result'] == nonce:
                 self.log.debug('Token is valid')
+                self._validated_at = time.monotonic()
                 return True
             else:
                 raise DropboxAPIError(resp.status, 'Token is invalid')
 
+    async def _download(self,
+                        url: str,
+                        api_arg: dict,
+                        local_path: str,
+                        chunk_size: typing.Optional[int] = None) -> str:
+        '''
+        Streams the response of a download endpoint to a file on the local disk.
+        Should not be called directly, this is used internally by the `download_*` methods.
+
+        Args:
+            url:
+                url of the download endpoint
+            api_arg:
+                arguments for the endpoint, sent in the Dropbox-API-Arg header
+            local_path:
+                Path on the local disk to download to
+            chunk_size:
+                number of bytes to read from the response at a time (default is None, which reads whatever data has arrived)
+        Returns:
+            str:
+                `local_path` where the file was downloaded to
+        '''
+
+        headers = {
+            "Dropbox-API-Arg": json.dumps(api_arg, separators=(',', ':'))
+        }
+
+        # limit how many files are open and being transferred at once
+        async with self._file_sem:
+            async with self._request(url,
+                                     headers=headers) as resp:
+                # blocking file calls run in a worker thread, chunks are
+                # collected into 4 MiB blocks so each thread hop writes a lot at once
+                f = await asyncio.to_thread(open, local_path, 'wb')
+                try:
+                    buf = bytearray()
+                    if chunk_size is None:
+                        chunks = resp.content.iter_any()
+                    else:
+                        chunks = resp.content.iter_chunked(chunk_size)
+                    async for chunk in chunks:
+                        buf += chunk
+                        if len(buf) >= 1 << 22:
+                            await asyncio.to_thread(f.write, buf)
+                            buf = bytearray()
+                    if buf:
+                        await asyncio.to_thread(f.write, buf)
+                finally:
+                    await asyncio.to_thread(f.close)
+                return local_path
+
     async def download_file(self,
                             dropbox_path: str,
-                            local_path: str = None) -> str:
+                            local_path: str = None,
+                            chunk_size: typing.Optional[int] = None) -> str:
         '''
         Downloads a single file.
         https://www.dropbox.com/developers/documentation/http/documentation#files-download
@@ -196,6 +579,8 @@ class AsyncDropboxAPI:
                 File path on Dropbox to download from
             local_path:
                 Path on the local disk to download to (defaults to None, which downloads to the current directory)
+            chunk_size:
+                number of bytes to read from the response at a time (default is None, which reads whatever data has arrived)
         Returns:
             str:
                 `local_path` where the file was downloaded to
@@ -205,27 +590,17 @@ class AsyncDropboxAPI:
         if local_path == None:
             local_path = os.path.basename(dropbox_path)
 
-        self.log.info(f'Downloading {os.path.basename(local_path)}')
-        self.log.debug(f'from {dropbox_path}')
+        self.log.info('Downloading %s', os.path.basename(local_path))
+        self.log.debug('from %s', dropbox_path)
 
-        url = 'https://content.dropboxapi.com/2/files/download'
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Dropbox-API-Arg": json.dumps({"path": dropbox_path})
-        }
-
-        async with Request(self.client_session.post,
-                           url,
-                           self.log,
-                           headers=headers) as resp:
-            async with aiofiles.open(local_path, 'wb') as f:
-                async for chunk, _ in resp.content.iter_chunks():
-                    await f.write(chunk)
-                return local_path
+        return await self._download(
+            'https://content.dropboxapi.com/2/files/download',
+            {"path": dropbox_path}, local_path, chunk_size)
 
     async def download_folder(self,
                               dropbox_path: str,
-                              local_path: str = None) -> str:
+                              local_path: str = None,
+                              chunk_size: typing.Optional[int] = None) -> str:
         '''
         Downloads a folder as a zip file.
         https://www.dropbox.com/developers/documentation/http/documentation#files-download_zip
@@ -235,6 +610,8 @@ class AsyncDropboxAPI:
                 Folder path on Dropbox to download from
             local_path:
                 Path on the local disk to download to (defaults to None, which downloads to the current directory)
+            chunk_size:
+                number of bytes to read from the response at a time (default is None, which reads whatever data has arrived)
         Returns:
             str:
                 `local_path` where the zip file was downloaded to
@@ -244,27 +621,17 @@ class AsyncDropboxAPI:
         if local_path == None:
             local_path = os.path.basename(dropbox_path)
 
-        self.log.info(f'Downloading {os.path.basename(local_path)}')
-        self.log.debug(f'from {dropbox_path}')
+        self.log.info('Downloading %s', os.path.basename(local_path))
+        self.log.debug('from %s', dropbox_path)
 
-        url = 'https://content.dropboxapi.com/2/files/download_zip'
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Dropbox-API-Arg": json.dumps({"path": dropbox_path})
-        }
-
-        async with Request(self.client_session.post,
-                           url,
-                           self.log,
-                           headers=headers) as resp:
-            async with aiofiles.open(local_path, 'wb') as f:
-                async for chunk, _ in resp.content.iter_chunks():
-                    await f.write(chunk)
-                return local_path
+        return await self._download(
+            'https://content.dropboxapi.com/2/files/download_zip',
+            {"path": dropbox_path}, local_path, chunk_size)
 
     async def download_shared_link(self,
                                    shared_link: str,
-                                   local_path: str = None) -> str:
+                                   local_path: str = None,
+                                   chunk_size: typing.Optional[int] = None) -> str:
         '''
         Downloads a file from a shared link.
         https://www.dropbox.com/developers/documentation/http/documentation#sharing-get_shared_link_file
@@ -274,6 +641,8 @@ class AsyncDropboxAPI:
                 Shared link to download from
             local_path:
                 Path on the local disk to download to (defaults to None, which downloads to the current directory)
+            chunk_size:
+                number of bytes to read from the response at a time (default is None, which reads whatever data has arrived)
         Returns:
             str:
                 `local_path` where the file was downloaded to
@@ -283,23 +652,12 @@ class AsyncDropboxAPI:
         if local_path == None:
             local_path = os.path.basename(shared_link[:shared_link.index('?')])
 
-        self.log.info(f'Downloading {os.path.basename(local_path)}')
-        self.log.debug(f'from {shared_link}')
+        self.log.info('Downloading %s', os.path.basename(local_path))
+        self.log.debug('from %s', shared_link)
 
-        url = 'https://content.dropboxapi.com/2/sharing/get_shared_link_file'
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Dropbox-API-Arg": json.dumps({"url": shared_link})
-        }
-
-        async with Request(self.client_session.post,
-                           url,
-                           self.log,
-                           headers=headers) as resp:
-            async with aiofiles.open(local_path, 'wb') as f:
-                async for chunk, _ in resp.content.iter_chunks():
-                    await f.write(chunk)
-                return local_path
+        return await self._download(
+            'https://content.dropboxapi.com/2/sharing/get_shared_link_file',
+            {"url": shared_link}, local_path, chunk_size)
 
     async def upload_start(self, local_path: str, dropbox_path: str) -> dict:
         '''
@@ -324,49 +682,178 @@ class AsyncDropboxAPI:
                 To avoid this, call `upload_finish` regularly to split high quantity uploads into batches.
         '''
 
-        if not os.path.exists(local_path):
+        try:
+            size = os.stat(local_path).st_size
+        except FileNotFoundError:
             raise ValueError(f"local_path {local_path} does not exist")
-        if len(self.upload_session) >= 1000:
+        if len(self.upload_session) + self._upload_pending >= 1000:
             raise RuntimeError(
                 'upload_session is too large, you must call upload_finish to commit the batch'
             )
 
-        self.log.info(f'Uploading {os.path.basename(local_path)}')
-        self.log.debug(f'to {dropbox_path}')
+        # reserve a place in the batch, so concurrent calls can't overfill it
+        self._upload_pending += 1
+        try:
+            self.log.info('Uploading %s', os.path.basename(local_path))
+            self.log.debug('to %s', dropbox_path)
+
+            url = 'https://content.dropboxapi.com/2/files/upload_session/start'
+            headers = {
+                **self._upload_start_headers,
+                "Content-Length": str(size)
+            }
+
+            # stream the file from disk instead of reading it into memory
+            # limit how many files are open and being transferred at once
+            async with self._file_sem:
+                async with self._request(url,
+                                         headers=headers,
+                                         data=functools.partial(
+                                             _open_upload, local_path)) as resp:
+                    resp_data = _loads(await resp.read())
+
+                    # construct commit entry for finishing batch later
+                    commit = {
+                        "cursor": {
+                            "session_id": resp_data['session_id'],
+                            "offset": size
+                        },
+                        "commit": {
+                            "path": dropbox_path,
+                            "mode": "add",
+                            "autorename": False,
+                            "mute": False
+                        }
+                    }
+                    self.upload_session.append(commit)
+                    return commit
+        finally:
+            self._upload_pending -= 1
+
+    async def upload_many(self,
+                          pairs: list[tuple[str, str]],
+                          concurrency: int = 16) -> list[dict]:
+        '''
+        Uploads many files to an upload session at once, by running `upload_start` concurrently.
+        The files still need to be committed with `upload_finish`.
+        If any upload fails, the remaining uploads are cancelled and the error is raised.
+        Files that finished uploading before the failure stay in `self.upload_session`.
 
-        url = 'https://content.dropboxapi.com/2/files/upload_session/start'
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Dropbox-API-Arg": json.dumps({"close": True}),
-            "Content-Type": "application/octet-stream"
-        }
+        Args:
+            pairs:
+                List of (local_path, dropbox_path) tuples to upload.
+            concurrency:
+                maximum number of files uploaded at the same time (default is 16)
+        Returns:
+            list[dict]:
+                UploadSessionFinishArg dicts for each file, in the same order as `pairs`.
+        Raises:
+            ValueError:
+                If any `local_path` does not exist.
+            RuntimeError:
+                If the upload session would grow larger than 1000 files.
+        '''
 
-        async with aiofiles.open(local_path, 'rb') as f:
-            data = await f.read()
-            async with Request(self.client_session.post,
-                               url,
-                               self.log,
-                               headers=headers,
-                               data=data) as resp:
-                resp_data = await resp.json()
-
-                # construct commit entry for finishing batch later
-                commit = {
-                    "cursor": {
-                        "session_id": resp_data['session_id'],
-                        "offset": os.path.getsize(local_path)
-                    },
-                    "commit": {
-                        "path": dropbox_path,
-                        "mode": "add",
-                        "autorename": False,
-                        "mute": False
-                    }
-                }
-                self.upload_session.append(commit)
-                return commit
+        if len(self.upload_session) + self._upload_pending + len(pairs) > 1000:
+            raise RuntimeError(
+                'upload_session is too large, you must call upload_finish to commit the batch'
+            )
+
+        sem = asyncio.Semaphore(concurrency)
+
+        async def _one(local_path: str, dropbox_path: str) -> dict:
+            async with sem:
+                return await self.upload_start(local_path, dropbox_path)
+
+        tasks = [asyncio.ensure_future(_one(l, d)) for l, d in pairs]
+        try:
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            # stop the other uploads, so nothing is added to the session after we raise
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    async def pipeline(
+        self,
+        shared_links: list[str],
+        dropbox_folder: str = '',
+        transform: typing.Optional[typing.Callable[[str],
+                                                   typing.Awaitable[str]]] = None,
+        download_concurrency: int = 10,
+        upload_concurrency: int = 10) -> list[dict]:
+        '''
+        Downloads files from shared links and uploads them to an upload session, overlapping the two.
+        Each file is uploaded as soon as its download (and `transform`) is done, instead of waiting for every download to finish.
+        The files still need to be committed with `upload_finish`.
+        If any download or upload fails, every other transfer is cancelled and the error is raised.
 
-    async def upload_finish(self, check_interval: float = 3) -> list[dict]:
+        Args:
+            shared_links:
+                Shared links to download from
+            dropbox_folder:
+                Dropbox folder to upload the files to (defaults to the root folder)
+            transform:
+                coroutine function that is called with each downloaded local path, and returns the local path to upload (default is None, which uploads the downloaded file as is)
+            download_concurrency:
+                maximum number of files downloaded at the same time (default is 10)
+            upload_concurrency:
+                maximum number of files uploaded at the same time (default is 10)
+        Returns:
+            list[dict]:
+                UploadSessionFinishArg dicts for each uploaded file, in the order the uploads finished
+        '''
+
+        queue: asyncio.Queue[typing.Optional[str]] = asyncio.Queue()
+        download_sem = asyncio.Semaphore(download_concurrency)
+
+        async def _download(shared_link: str) -> None:
+            async with download_sem:
+                local_path = await self.download_shared_link(shared_link)
+            if transform is not None:
+                local_path = await transform(local_path)
+            await queue.put(local_path)
+
+        async def _upload() -> list[dict]:
+            commits = []
+            # None is pushed once per uploader when all downloads are done
+            while (local_path := await queue.get()) is not None:
+                dropbox_path = f"{dropbox_folder.rstrip('/')}/{os.path.basename(local_path)}"
+                commits.append(await self.upload_start(local_path, dropbox_path))
+            return commits
+
+        downloaders = [
+            asyncio.ensure_future(_download(l)) for l in shared_links
+        ]
+        uploaders = [
+            asyncio.ensure_future(_upload()) for _ in range(upload_concurrency)
+        ]
+        tasks = downloaders + uploaders
+        try:
+            # wait for the downloads, raising as soon as any download or upload fails
+            waiting = set(tasks)
+            while not waiting.isdisjoint(downloaders):
+                # uploaders only finish early by failing, so any completion is worth checking
+                done, waiting = await asyncio.wait(
+                    waiting, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()
+            for _ in uploaders:
+                await queue.put(None)
+            results = await asyncio.gather(*uploaders)
+        except BaseException:
+            # don't leave any transfers running in the background
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+        return [commit for result in results for commit in result]
+
+    async def upload_finish(self,
+                            check_interval: float = 3,
+                            parallel_batches: int = 1) -> list[dict]:
         '''
         Finishes an upload batch.
         https://www.dropbox.com/developers/documentation/http/documentation#files-upload_session-finish_batch
@@ -374,6 +861,10 @@ class AsyncDropboxAPI:
         Args:
             check_interval:
                 how often to check on the upload completion status (default is 3)
+            parallel_batches:
+                number of evenly sized sub-batches to split the batch into and commit concurrently (default is 1).
+                Dropbox locks the namespace while committing, so values above 1 can cause extra rate limiting.
+                If a sub-batch fails, the others are still committed and only the failed entries stay in `self.upload_session`.
         Returns:
             list[dict]:
                 List of FileMetadata dicts containing metadata on each uploaded file
@@ -387,40 +878,70 @@ class AsyncDropboxAPI:
                 "upload_session is empty, have you uploaded any files yet?")
 
         self.log.info('Finishing upload batch')
-        self.log.debug(f'Batch size is {len(self.upload_session)}')
+        self.log.debug('Batch size is %d', len(self.upload_session))
 
-        url = 'https://api.dropboxapi.com/2/files/upload_session/finish_batch'
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Content-Type": "application/json"
-        }
-        data = json.dumps({"entries": self.upload_session})
+        # copy, upload_start may still append to the session while we wait
+        entries = self.upload_session[:]
+        count = min(max(parallel_batches, 1), len(entries))
+        size = -(-len(entries) // count)
+        groups = [entries[i:i + size] for i in range(0, len(entries), size)]
 
-        async with Request(self.client_session.post,
-                           url,
-                           self.log,
-                           headers=headers,
-                           data=data) as resp:
-            resp_data = await resp.json()
-            self.upload_session = []  # empty the local upload session
+        url = 'https://api.dropboxapi.com/2/files/upload_session/finish_batch'
+        headers = self._json_headers
+
+        async def _start(group: list[dict]) -> dict:
+            async with self._request(url,
+                                     headers=headers,
+                                     data=_dumps({"entries": group})) as resp:
+                resp_data = _loads(await resp.read())
+                if resp_data['.tag'] not in ('async_job_id', 'complete'):
+                    err = (await resp.read()).decode('utf-8', 'replace')
+                    raise DropboxAPIError(
+                        resp.status, f'Unknown upload_finish response: {err}')
+                return resp_data
 
+        async def _finish(resp_data: dict) -> list[dict]:
             if resp_data['.tag'] == 'async_job_id':
                 # check regularly for job completion
                 return await self._upload_finish_check(
                     resp_data['async_job_id'], check_interval=check_interval)
-            elif resp_data['.tag'] == 'complete':
+            else:
                 self.log.info('Upload batch finished')
                 return resp_data['entries']
-            else:
-                err = await resp.text()
-                raise DropboxAPIError(
-                    resp.status, f'Unknown upload_finish response: {err}')
+
+        # let every sub-batch finish, so the ones Dropbox accepted can be removed even if another failed
+        started = await asyncio.gather(*(_start(g) for g in groups),
+                                       return_exceptions=True)
+        committed = {
+            id(entry)
+            for group, result in zip(groups, started)
+            if not isinstance(result, BaseException) for entry in group
+        }
+        self.upload_session = [
+            entry for entry in self.upload_session if id(entry) not in committed
+        ]
+        for result in started:
+            if isinstance(result, BaseException):
+                raise result
+
+        tasks = [asyncio.ensure_future(_finish(r)) for r in started]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            # stop the other pollers, so no check requests are sent after we raise
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        return [entry for result in results for entry in result]
 
     async def _upload_finish_check(self,
                                    job_id: str,
-                                   check_interval: float = 5) -> list[dict]:
+                                   check_interval: float = 5,
+                                   max_interval: float = 30) -> list[dict]:
         '''
-        Checks on an `upload_finish` async job every `check_interval` seconds.
+        Checks on an `upload_finish` async job, starting after `check_interval` seconds.
+        The wait grows by 1.5x after every check up to `max_interval`, unless the API sends a Retry-After header (also capped at `max_interval`).
         Should not be called directly, this is automatically called from `upload_finish`.
         https://www.dropbox.com/developers/documentation/http/documentation#files-upload_session-finish_batch-check:w
 
@@ -428,37 +949,39 @@ class AsyncDropboxAPI:
             job_id:
                 the job ID to check the status of
             check_interval:
-                how often in seconds to check the status
+                how long in seconds to wait before the first check
+            max_interval:
+                longest time in seconds to wait between checks (default is 30)
         Returns:
             list[dict]:
                 List of FileMetadata dicts containing metadata on each uploaded file
         '''
 
-        self.log.debug(
-            f'Batch not finished, checking every {check_interval} seconds')
+        self.log.debug('Batch not finished, checking in %s seconds',
+                       check_interval)
 
         url = 'https://api.dropboxapi.com/2/files/upload_session/finish_batch/check'
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Content-Type": "application/json"
-        }
-        data = json.dumps({"async_job_id": job_id})
+        headers = self._json_headers
+        data = _dumps({"async_job_id": job_id})
 
+        delay = check_interval
         while True:
-            await asyncio.sleep(check_interval)
-            async with Request(self.client_session.post,
-                               url,
-                               self.log,
-                               headers=headers,
-                               data=data) as resp:
-                resp_data = await resp.json()
+            await asyncio.sleep(delay)
+            async with self._request(url,
+                                     headers=headers,
+                                     data=data) as resp:
+                resp_data = _loads(await resp.read())
 
                 if resp_data['.tag'] == 'complete':
                     self.log.info('Upload batch finished')
                     return resp_data['entries']
                 elif resp_data['.tag'] == 'in_progress':
-                    self.log.debug(
-                        f'Checking again in {check_interval} seconds')
+                    retry_after = _retry_after(resp)
+                    if retry_after is not None:
+                        delay = min(retry_after, max_interval)
+                    else:
+                        delay = min(delay * 1.5, max_interval)
+                    self.log.debug('Checking again in %.2f seconds', delay)
                     continue
 
     async def upload_single(
@@ -489,28 +1012,30 @@ class AsyncDropboxAPI:
                 If `local_path` does not exist.
         '''
 
-        if not os.path.exists(local_path):
+        try:
+            size = os.stat(local_path).st_size
+        except FileNotFoundError:
             raise ValueError(f"local_path {local_path} does not exist")
         args['path'] = dropbox_path
 
-        self.log.info(f'Uploading {os.path.basename(local_path)}')
-        self.log.debug(f'to {dropbox_path}')
+        self.log.info('Uploading %s', os.path.basename(local_path))
+        self.log.debug('to %s', dropbox_path)
 
         url = 'https://content.dropboxapi.com/2/files/upload'
         headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Dropbox-API-Arg": json.dumps(args),
-            "Content-Type": "application/octet-stream"
+            **self._octet_headers,
+            "Dropbox-API-Arg": json.dumps(args, separators=(',', ':')),
+            "Content-Length": str(size)
         }
 
-        async with aiofiles.open(local_path, 'rb') as f:
-            data = await f.read()
-            async with Request(self.client_session.post,
-                               url,
-                               self.log,
-                               headers=headers,
-                               data=data) as resp:
-                resp_data = await resp.json()
+        # stream the file from disk instead of reading it into memory
+        # limit how many files are open and being transferred at once
+        async with self._file_sem:
+            async with self._request(url,
+                                     headers=headers,
+                                     data=functools.partial(
+                                         _open_upload, local_path)) as resp:
+                resp_data = _loads(await resp.read())
                 return resp_data
 
     async def create_shared_link(self, dropbox_path: str) -> str:
@@ -530,40 +1055,35 @@ class AsyncDropboxAPI:
                 If `dropbox_path` does not exist on Dropbox, or if an otherwise unknown status is returned.
         '''
 
-        self.log.info(
-            f'Creating shared link for file {os.path.basename(dropbox_path)}')
-        self.log.debug(f'Full path is {dropbox_path}')
+        self.log.info('Creating shared link for file %s',
+                      os.path.basename(dropbox_path))
+        self.log.debug('Full path is %s', dropbox_path)
 
         url = 'https://api.dropboxapi.com/2/sharing/create_shared_link_with_settings'
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Content-Type": "application/json"
-        }
-        data = json.dumps({'path': dropbox_path})
+        headers = self._json_headers
+        data = _dumps({'path': dropbox_path})
 
         # accept 409 status to check for existing shared link
-        async with Request(self.client_session.post,
-                           url,
-                           self.log,
-                           headers=headers,
-                           data=data,
-                           ok_statuses=[200, 409]) as resp:
-            resp_data = await resp.json()
+        async with self._request(url,
+                                 headers=headers,
+                                 data=data,
+                                 ok_statuses=[200, 409]) as resp:
+            resp_data = _loads(await resp.read())
 
             if resp.status == 200:
                 return resp_data['url']
             else:
                 if 'shared_link_already_exists' in resp_data['error_summary']:
                     self.log.warning(
-                        f'Shared link already exists for {os.path.basename(dropbox_path)}, using existing link'
-                    )
+                        'Shared link already exists for %s, using existing link',
+                        os.path.basename(dropbox_path))
                     return resp_data['error']['shared_link_already_exists'][
                         'metadata']['url']
                 elif 'not_found' in resp_data['error_summary']:
                     raise DropboxAPIError(
                         resp.status, f'Path {dropbox_path} does not exist')
                 else:
-                    err = await resp.text()
+                    err = (await resp.read()).decode('utf-8', 'replace')
                     raise DropboxAPIError(resp.status,
                                           f'Unknown Dropbox error: {err}')
 
@@ -580,25 +1100,30 @@ class AsyncDropboxAPI:
                 FileMetadata or FolderMetadata for the file/folder behind the shared link
         '''
 
-        self.log.info(f'Getting metadata from shared link {shared_link}')
+        self.log.info('Getting metadata from shared link %s', shared_link)
 
         url = 'https://api.dropboxapi.com/2/sharing/get_shared_link_metadata'
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Content-Type": "application/json"
-        }
-        data = json.dumps({'url': shared_link})
-
-        async with Request(self.client_session.post,
-                           url,
-                           self.log,
-                           headers=headers,
-                           data=data) as resp:
-            resp_data = await resp.json()
+        headers = self._json_headers
+        data = _dumps({'url': shared_link})
+
+        async with self._request(url,
+                                 headers=headers,
+                                 data=data) as resp:
+            resp_data = _loads(await resp.read())
             return resp_data
 
+    async def close(self):
+        '''
+        Closes the HTTP session. Called automatically at the end of an `async with` block.
+        '''
+
+        if self.client_session is not None:
+            await self.client_session.close()
+            self.client_session = None
+            self._post = None
+
     async def __aenter__(self):
         return self
 
     async def __aexit__(self, *excinfo):
-        await self.client_session.close()
+        await self.close()
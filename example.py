@@ -1,4 +1,5 @@
 import os
+import sys
 import asyncio
 import logging
 
@@ -35,7 +36,7 @@ async def main(token: str, shared_links: list[str], log: logging.Logger):
         for coro in asyncio.as_completed(coroutines):
             try:
                 res = await coro
-            except aiodbx.DropboxApiError as e:
+            except aiodbx.DropboxAPIError as e:
                 # this exception is raised when the API returns an error
                 log.error('Encountered an error')
                 log.error(e)
@@ -75,4 +76,15 @@ if __name__ == '__main__':
     ]
 
     # run our main function
-    asyncio.get_event_loop().run_until_complete(main(token, shared_links, log))
+    # uvloop is optional, but makes the event loop itself faster if it is installed
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main(token, shared_links, log))
+    else:
+        if sys.version_info >= (3, 11):
+            with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+                runner.run(main(token, shared_links, log))
+        else:
+            uvloop.install()
+            asyncio.run(main(token, shared_links, log))